@@ -2,6 +2,7 @@ import tkinter as tk
 from tkinter import ttk, scrolledtext, simpledialog, messagebox
 import firebase_admin
 from firebase_admin import credentials, db
+import collections
 import threading
 import queue
 from datetime import datetime
@@ -10,15 +11,79 @@ import os
 from tkinter import font as tkfont
 import webbrowser
 
+MAX_LINES = 1000  # Chat lines kept in the display before pruning the oldest
+HISTORY_SIZE = 100  # Messages shown from the initial snapshot
+MAX_PENDING = 500  # Messages buffered between two UI deliveries
+MAX_RECONNECT_DELAY = 30  # Seconds; cap for the listener's exponential backoff
+
+# Message line separators, shared by the display and the history file
+SEP = ": "
+BR = "\n"
+
+
+def normalize_timestamp(value):
+    """Return a stored timestamp as an ISO string, or "" if unusable"""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        # Date.now() / ServerValue.TIMESTAMP from other clients: epoch millis
+        try:
+            return datetime.fromtimestamp(value / 1000).isoformat()
+        except (OverflowError, OSError, ValueError):
+            return ""
+    return ""
+
+
+def message_sort_key(item):
+    """Order (push key, message) pairs by timestamp, then push key"""
+    key, data = item
+    return (normalize_timestamp(data.get("timestamp")), key)
+
+# Color maps for the light/dark ttk themes and chat text tags
+THEMES = {
+    "light": {
+        "bg": "#f5f5f5",
+        "fg": "#000000",
+        "entry_bg": "#ffffff",
+        "time": "gray",
+        "self": "blue",
+        "system": "red"
+    },
+    "dark": {
+        "bg": "#2d2d2d",
+        "fg": "#ffffff",
+        "entry_bg": "#3d3d3d",
+        "time": "#aaaaaa",
+        "self": "#6cb4ff",
+        "system": "#ff6b6b"
+    }
+}
+
 class ModernChatApp:
+    _fonts = None  # (base, bold) shared by app instances on the same Tk interpreter
+
     def __init__(self, root):
         self.root = root
+        self.theme = "light"  # light/dark mode
         self.setup_window()
-        self.message_queue = queue.Queue()
-        self.running = True
+        self._stop = threading.Event()
+        self._listener_thread = None
+        self._listener_registration = None
+        self._listener_lock = threading.Lock()  # Guards the registration hand-off
+        self._send_thread = None
+        self._pending = collections.deque(maxlen=MAX_PENDING)
+        self._pending_lock = threading.Lock()
+        self._deliver_scheduled = False
         self.current_username = None
-        self.message_count = 0
-        self.theme = "light"  # light/dark mode
+        self.line_count = 0
+        self._snapshot_loaded = False
+        self._seen_keys = set()  # Firebase push keys already queued or skipped
+        self._unsaved = []  # Lines not yet appended to chat_history.txt
+        self._send_queue = queue.Queue()
+        self._pending_status = None
+        self._status_scheduled = False
+        self._visible = True
+        self._hidden_buffer = []  # Messages delivered while minimized
         
         # UI Setup
         self.create_menu()
@@ -30,7 +95,9 @@ class ModernChatApp:
             self.show_fallback_warning()
         
         # Start services
-        self.root.after(100, self.process_messages)
+        if self.firebase_active:
+            self._send_thread = threading.Thread(target=self.send_worker, daemon=True)
+            self._send_thread.start()
         self.setup_auto_save()
 
     def setup_window(self):
@@ -38,7 +105,7 @@ class ModernChatApp:
         self.root.title("NeoChat - Secure Classroom Messenger")
         self.root.geometry("1000x700")
         self.root.minsize(800, 600)
-        self.root.configure(bg="#f5f5f5")
+        self.root.configure(bg=THEMES[self.theme]["bg"])
         
         # Center window on screen
         self.root.update_idletasks()
@@ -47,6 +114,11 @@ class ModernChatApp:
         ws = self.root.winfo_screenwidth()
         hs = self.root.winfo_screenheight()
         self.root.geometry(f'+{(ws-w)//2}+{(hs-h)//2}')
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        
+        # Pause rendering while minimized/withdrawn
+        self.root.bind("<Map>", self._on_map)
+        self.root.bind("<Unmap>", self._on_unmap)
 
     def create_menu(self):
         """Create menu bar with options"""
@@ -77,14 +149,14 @@ class ModernChatApp:
     def setup_ui(self):
         """Initialize all UI components"""
         # Custom fonts
-        self.base_font = tkfont.Font(family="Segoe UI", size=12)
-        self.bold_font = tkfont.Font(family="Segoe UI", size=12, weight="bold")
+        self.base_font, self.bold_font = self._init_fonts(self.root)
         
         # Main container
         main_frame = ttk.Frame(self.root)
         main_frame.pack(expand=True, fill="both", padx=10, pady=10)
         
         # Chat display
+        colors = THEMES[self.theme]
         self.chat_display = scrolledtext.ScrolledText(
             main_frame,
             wrap=tk.WORD,
@@ -92,12 +164,18 @@ class ModernChatApp:
             font=self.base_font,
             padx=10,
             pady=10,
-            bg="white",
-            fg="black",
-            insertbackground="black"
+            bg=colors["entry_bg"],
+            fg=colors["fg"],
+            insertbackground=colors["fg"]
         )
         self.chat_display.pack(expand=True, fill="both")
         
+        # Formatting tags
+        self.chat_display.tag_config("time", foreground=colors["time"])
+        self.chat_display.tag_config("username", font=self.bold_font)
+        self.chat_display.tag_config("self", foreground=colors["self"])
+        self.chat_display.tag_config("system", foreground=colors["system"])
+        
         # Bottom panel
         bottom_frame = ttk.Frame(main_frame)
         bottom_frame.pack(fill="x", pady=(5, 0))
@@ -131,13 +209,40 @@ class ModernChatApp:
         
         # Configure styles
         self.style = ttk.Style()
-        self.style.configure("Accent.TButton", foreground="white", background="#4CAF50")
-        self.style.map("Accent.TButton",
-                      background=[("active", "#45a049"), ("disabled", "#cccccc")])
+        self.create_themes()
+        self.style.theme_use(f"neochat_{self.theme}")
         
         # Initial username prompt
         self.change_username()
 
+    def create_themes(self):
+        """Register the light/dark ttk themes once so switching is O(1)"""
+        existing = self.style.theme_names()
+        for name, colors in THEMES.items():
+            if f"neochat_{name}" in existing:
+                continue
+            self.style.theme_create(f"neochat_{name}", parent="clam", settings={
+                ".": {"configure": {"background": colors["bg"], "foreground": colors["fg"]}},
+                "TFrame": {"configure": {"background": colors["bg"]}},
+                "TLabel": {"configure": {"background": colors["bg"], "foreground": colors["fg"]}},
+                "TEntry": {"configure": {"fieldbackground": colors["entry_bg"], "foreground": colors["fg"]}},
+                "Accent.TButton": {
+                    "configure": {"foreground": "white", "background": "#4CAF50"},
+                    "map": {"background": [("active", "#45a049"), ("disabled", "#cccccc")]}
+                }
+            })
+
+    @classmethod
+    def _init_fonts(cls, root):
+        """Create the chat fonts once per Tk interpreter and reuse them afterwards"""
+        # Named fonts belong to the interpreter that created them
+        if cls._fonts is None or cls._fonts[0]._tk is not root.tk:
+            cls._fonts = (
+                tkfont.Font(root=root, family="Segoe UI", size=12),
+                tkfont.Font(root=root, family="Segoe UI", size=12, weight="bold")
+            )
+        return cls._fonts
+
     def initialize_firebase(self):
         """Initialize Firebase with multiple fallback options"""
         try:
@@ -148,10 +253,10 @@ class ModernChatApp:
                 db_url = os.getenv("DATABASE_URL")
             # Try local config file (for development)
             elif os.path.exists("firebase_config.json"):
-                cred = credentials.Certificate("firebase_config.json")
                 with open("firebase_config.json") as f:
                     config = json.load(f)
-                    db_url = config.get("databaseURL")
+                cred = credentials.Certificate(config)
+                db_url = config.get("databaseURL")
             else:
                 return False
                 
@@ -168,97 +273,215 @@ class ModernChatApp:
     def setup_listener(self):
         """Set up real-time Firebase listener"""
         def listener():
-            try:
-                self.db_ref.limit_to_last(100).listen(self.message_handler)
-            except Exception as e:
-                self.queue_message("SYSTEM", f"Connection error: {str(e)}")
-                self.update_status("Connection lost", "red")
+            attempt = 0
+            while not self._stop.is_set():
+                try:
+                    registration = self.db_ref.listen(self.message_handler)
+                except Exception as e:
+                    delay = min(MAX_RECONNECT_DELAY, 2 ** attempt)
+                    if self._stop.is_set():
+                        return  # on_close may already have destroyed the root
+                    if attempt == 0:
+                        # Later retries only show in the status bar
+                        self.queue_message("SYSTEM", f"Connection error: {str(e)} (retrying in background)")
+                    attempt += 1
+                    self.root.after(0, self.update_status, "Connection lost", "red")
+                    self._stop.wait(delay)  # Returns early on shutdown
+                    continue
+                
+                with self._listener_lock:
+                    if not self._stop.is_set():
+                        self._listener_registration = registration
+                        registration = None
+                if registration:
+                    # on_close ran while listen() was connecting; the SDK's
+                    # stream thread is non-daemon, so close it here
+                    registration.close()
+                elif attempt and not self._stop.is_set():
+                    self.root.after(0, self.update_status, "Connected to Firebase", "green")
+                return  # The SDK keeps the stream alive from here
         
-        threading.Thread(target=listener, daemon=True).start()
+        self._listener_thread = threading.Thread(target=listener, daemon=True)
+        self._listener_thread.start()
 
     def message_handler(self, event):
-        """Handle incoming Firebase messages"""
-        if event.data and isinstance(event.data, dict):
-            self.queue_message(
-                event.data.get("sender", "Unknown"),
-                event.data.get("message", ""),
-                event.data.get("timestamp", "")
+        """Handle incoming Firebase messages, deduplicated by push key"""
+        if event.path == "/":
+            # Whole-node snapshot, sent on connect and again on every reconnect
+            children = event.data if isinstance(event.data, dict) else {}
+            messages = sorted(
+                ((key, data) for key, data in children.items()
+                 if isinstance(data, dict) and data.get("message")),
+                key=message_sort_key
             )
+            if not self._snapshot_loaded:
+                # First snapshot: show only the most recent messages as history
+                self._snapshot_loaded = True
+                self._seen_keys.update(children)
+                for key, data in messages[-HISTORY_SIZE:]:
+                    self.queue_firebase_message(data, history=True)
+                return
+            
+            # Reconnect: show whatever arrived while the stream was down
+            for key, data in messages:
+                if key not in self._seen_keys:
+                    self._seen_keys.add(key)
+                    self.queue_firebase_message(data)
+            return
+        
+        # "/<push key>" is a new message; deeper paths are field edits
+        key, _, field = event.path.strip("/").partition("/")
+        if field or key in self._seen_keys:
+            return
+        if isinstance(event.data, dict) and event.data.get("message"):
+            self._seen_keys.add(key)
+            self.queue_firebase_message(event.data)
 
-    def queue_message(self, sender, message, timestamp=""):
-        """Thread-safe message queuing"""
-        self.message_queue.put({
+    def queue_firebase_message(self, data, history=False):
+        """Queue a message record read from Firebase"""
+        # Other clients may store non-string values; render them as text
+        self.queue_message(
+            str(data.get("sender", "Unknown")),
+            str(data["message"]),
+            normalize_timestamp(data.get("timestamp")),
+            history=history
+        )
+
+    def queue_message(self, sender, message, timestamp="", history=False):
+        """Thread-safe message delivery to the UI thread"""
+        if self._stop.is_set():
+            return  # Shutting down; the window may already be gone
+        
+        # Format the time on the calling thread so rendering does no parsing
+        if timestamp:
+            try:
+                time_str = datetime.fromisoformat(timestamp).strftime("%H:%M")
+            except (TypeError, ValueError):
+                time_str = "--:--"
+        else:
+            time_str = datetime.now().strftime("%H:%M")
+        
+        msg = {
             "sender": sender,
             "message": message,
-            "timestamp": timestamp or datetime.now().isoformat()
-        })
+            "time_str": time_str,
+            "history": history  # Replayed on connect; not appended to the file again
+        }
+        with self._pending_lock:
+            self._pending.append(msg)
+            if self._deliver_scheduled:
+                return  # Already picked up by the next batch
+            self._deliver_scheduled = True
+        
+        if threading.current_thread() is threading.main_thread():
+            self._deliver()
+        else:
+            # Marshal onto the Tk main loop once per batch
+            self.root.after(0, self._deliver)
 
-    def process_messages(self):
-        """Process queued messages in main thread"""
-        while not self.message_queue.empty():
-            msg = self.message_queue.get()
-            self.display_message(**msg)
+    def _deliver(self):
+        """Display all pending messages in main thread"""
+        with self._pending_lock:
+            batch, self._pending = self._pending, collections.deque(maxlen=MAX_PENDING)
+            self._deliver_scheduled = False
+        
+        if self._stop.is_set() or not batch:
+            return
         
-        if self.running:
-            self.root.after(100, self.process_messages)
+        self._unsaved.extend(
+            "[" + m["time_str"] + "] " + m["sender"] + SEP + m["message"] + BR
+            for m in batch if not m["history"]
+        )
+        if self._visible:
+            self.display_messages(batch)
+        else:
+            # Older messages would be pruned on render anyway
+            self._hidden_buffer.extend(batch)
+            del self._hidden_buffer[:-MAX_LINES]
 
-    def display_message(self, sender, message, timestamp):
-        """Display message in chat with formatting"""
+    def _on_map(self, event):
+        """Render messages held back while the window was hidden"""
+        if event.widget is not self.root or self._visible:
+            return
+        self._visible = True
+        if self._hidden_buffer:
+            batch, self._hidden_buffer = self._hidden_buffer, []
+            self.display_messages(batch)
+
+    def _on_unmap(self, event):
+        """Stop rendering while the window is minimized or withdrawn"""
+        if event.widget is self.root:
+            self._visible = False
+
+    def display_messages(self, messages):
+        """Display a batch of messages with a single widget state toggle"""
+        # Only follow new messages if the user hasn't scrolled up
+        at_bottom = self.chat_display.yview()[1] > 0.95
+        
+        self.chat_display.config(state="normal")
         try:
-            time_str = datetime.fromisoformat(timestamp).strftime("%H:%M")
-            self.chat_display.config(state="normal")
-            
-            # Formatting tags
-            self.chat_display.tag_config("time", foreground="gray")
-            self.chat_display.tag_config("username", font=self.bold_font)
-            self.chat_display.tag_config("self", foreground="blue")
-            self.chat_display.tag_config("system", foreground="red")
-            
-            # Determine message type
-            if sender == "SYSTEM":
-                tag = "system"
-            elif sender == self.current_username:
-                tag = "self"
-            else:
-                tag = ""
-            
-            # Insert message
-            self.chat_display.insert("end", f"[", "time")
-            self.chat_display.insert("end", time_str, "time")
-            self.chat_display.insert("end", "] ", "time")
-            self.chat_display.insert("end", f"{sender}: ", "username")
-            self.chat_display.insert("end", f"{message}\n", tag)
+            for msg in messages:
+                self.display_message(msg["sender"], msg["message"], msg["time_str"])
+        finally:
+            # Drop the oldest lines so the widget stays a fixed size
+            if self.line_count > MAX_LINES:
+                excess = self.line_count - MAX_LINES
+                self.chat_display.delete("1.0", f"{excess + 1}.0")
+                self.line_count -= excess
             
+            # Never leave the transcript editable, even if an insert failed
             self.chat_display.config(state="disabled")
+        
+        if at_bottom:
             self.chat_display.see("end")
-            self.message_count += 1
-            
-            # Auto-scroll if near bottom
-            if self.chat_display.yview()[1] > 0.9:
-                self.chat_display.see("end")
-                
-        except tk.TclError:
-            pass  # Window destroyed
+
+    def display_message(self, sender, message, time_str):
+        """Insert one message into the (already writable) chat display"""
+        # Determine message type
+        if sender == "SYSTEM":
+            tag = "system"
+        elif sender == self.current_username:
+            tag = "self"
+        else:
+            tag = ""
+        
+        # Insert message (one Tcl call for all tagged chunks)
+        self.chat_display.insert(
+            "end",
+            "[" + time_str + "] ", "time",
+            sender + SEP, "username",
+            message + BR, tag
+        )
+        self.line_count += message.count(BR) + 1
 
     def send_message(self, event=None):
         """Send message to Firebase"""
         message = self.msg_entry.get().strip()
         if message and self.current_username:
+            if self.firebase_active:
+                # Network I/O happens on the send worker, not the Tk callback
+                self._send_queue.put({
+                    "sender": self.current_username,
+                    "message": message,
+                    "timestamp": datetime.now().isoformat()
+                })
+            else:
+                # Offline mode
+                self.queue_message(
+                    self.current_username,
+                    message,
+                    datetime.now().isoformat()
+                )
+            self.msg_entry.delete(0, "end")
+
+    def send_worker(self):
+        """Push queued outgoing messages to Firebase in background thread"""
+        while not self._stop.is_set():
+            item = self._send_queue.get()
+            if item is None:
+                break  # Shutdown sentinel
             try:
-                if self.firebase_active:
-                    self.db_ref.push({
-                        "sender": self.current_username,
-                        "message": message,
-                        "timestamp": datetime.now().isoformat()
-                    })
-                else:
-                    # Offline mode
-                    self.queue_message(
-                        self.current_username,
-                        message,
-                        datetime.now().isoformat()
-                    )
-                self.msg_entry.delete(0, "end")
+                self.db_ref.push(item)
             except Exception as e:
                 self.queue_message("SYSTEM", f"Send failed: {str(e)}")
 
@@ -282,48 +505,52 @@ class ModernChatApp:
         self.chat_display.config(state="normal")
         self.chat_display.delete(1.0, "end")
         self.chat_display.config(state="disabled")
-        self.message_count = 0
+        self.line_count = 0
 
     def set_theme(self, theme):
         """Change between light/dark themes"""
         self.theme = theme
-        if theme == "dark":
-            bg = "#2d2d2d"
-            fg = "#ffffff"
-            entry_bg = "#3d3d3d"
-        else:
-            bg = "#f5f5f5"
-            fg = "#000000"
-            entry_bg = "#ffffff"
-        
-        # Apply colors
-        self.root.configure(bg=bg)
-        self.chat_display.configure(bg=entry_bg, fg=fg)
-        self.msg_entry.configure(style=f"{theme}.TEntry")
+        colors = THEMES[theme]
+        self.style.theme_use(f"neochat_{theme}")
         
-        # Configure styles
-        self.style.configure(".", background=bg, foreground=fg)
-        self.style.configure("TFrame", background=bg)
-        self.style.configure("TLabel", background=bg, foreground=fg)
-        self.style.configure("TEntry", fieldbackground=entry_bg, foreground=fg)
+        # Plain Tk widgets are not covered by the ttk theme
+        self.root.configure(bg=colors["bg"])
+        self.chat_display.configure(
+            bg=colors["entry_bg"],
+            fg=colors["fg"],
+            insertbackground=colors["fg"]
+        )
+        self.chat_display.tag_config("time", foreground=colors["time"])
+        self.chat_display.tag_config("self", foreground=colors["self"])
+        self.chat_display.tag_config("system", foreground=colors["system"])
         
         self.queue_message("SYSTEM", f"Switched to {theme} mode")
 
     def update_status(self, text, color="black"):
-        """Update status bar message"""
+        """Update status bar message, coalescing bursts within 200 ms"""
+        self._pending_status = (text, color)
+        if not self._status_scheduled:
+            self._status_scheduled = True
+            self.root.after(200, self._flush_status)
+
+    def _flush_status(self):
+        """Apply the latest pending status to the status bar"""
+        self._status_scheduled = False
+        text, color = self._pending_status
         self.status_bar.config(text=text, foreground=color)
 
     def setup_auto_save(self):
-        """Periodically save chat history"""
-        if self.message_count % 10 == 0 and self.message_count > 0:
+        """Periodically save new chat lines"""
+        if self._unsaved:
             self.save_chat_history()
         self.root.after(60000, self.setup_auto_save)  # Every minute
 
     def save_chat_history(self):
-        """Save chat to local file"""
+        """Append unsaved chat lines to local file"""
         try:
-            with open("chat_history.txt", "w", encoding="utf-8") as f:
-                f.write(self.chat_display.get(1.0, "end"))
+            with open("chat_history.txt", "a", encoding="utf-8") as f:
+                f.writelines(self._unsaved)
+            self._unsaved.clear()
         except Exception as e:
             print(f"Failed to save chat: {str(e)}")
 
@@ -354,8 +581,36 @@ class ModernChatApp:
 
     def on_close(self):
         """Clean shutdown procedure"""
-        self.running = False
-        if self.message_count > 0:
+        if self._stop.is_set():
+            return  # Already shutting down
+        self._stop.set()
+        self._send_queue.put(None)  # Wake the send worker
+        self.root.withdraw()
+        
+        # Background threads may be blocked in root.after(), which only a
+        # running Tk loop can serve, so wait for them off the Tk thread
+        closer = threading.Thread(target=self._stop_workers, daemon=True)
+        closer.start()
+        self._finish_close(closer)
+
+    def _stop_workers(self):
+        """Join background threads and close the Firebase listener"""
+        for thread in (self._listener_thread, self._send_thread):
+            if thread:
+                thread.join(timeout=1)
+        
+        # A listener still connecting sees _stop under this lock and closes itself
+        with self._listener_lock:
+            registration, self._listener_registration = self._listener_registration, None
+        if registration:
+            registration.close()
+
+    def _finish_close(self, closer):
+        """Destroy the window once the background shutdown has finished"""
+        if closer.is_alive():
+            self.root.after(50, self._finish_close, closer)
+            return
+        if self._unsaved:
             self.save_chat_history()
         self.root.destroy()
 